@@ -1,35 +1,328 @@
 import io
+import json
 import os
-from typing import Any, Dict
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 
 import boto3
-import pandas as pd
+import pyarrow as pa
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from pyarrow import csv as pacsv
+from pyarrow import parquet as pq
 
-# Initialize the S3 client
-s3 = boto3.client("s3")
+# Initialize the S3 client once per container so warm invocations reuse connections
+s3 = boto3.client(
+    "s3",
+    config=Config(
+        max_pool_connections=50,
+        retries={"mode": "adaptive", "max_attempts": 3},
+        tcp_keepalive=True,
+        s3={"use_accelerate_endpoint": False, "addressing_style": "virtual"},
+    ),
+)
 
 # Constants for S3 bucket and folder paths
 bucket_name = os.getenv("bucket_name", "aws-lambda-pet-project-bucket")
 incoming_folder = os.getenv("incoming_folder", "incoming/")
 archive_folder = os.getenv("archive_folder", "archive/")
+incoming_folder_length = len(incoming_folder)
 
+# Columns projected server-side with S3 Select (comma-separated, empty for all)
+select_columns = [
+    column.strip()
+    for column in os.getenv("select_columns", "").split(",")
+    if column.strip()
+]
 
-def s3_file_exist(destination_path: str) -> bool:
+# Parquet encoding settings (empty level uses the codec default, required for
+# codecs without levels such as snappy or none)
+parquet_compression = os.getenv("parquet_compression", "zstd")
+parquet_compression_level = os.getenv("parquet_compression_level", "3")
+parquet_compression_level = (
+    int(parquet_compression_level) if parquet_compression_level else None
+)
+
+# Fail at cold start rather than after downloading the CSV
+if parquet_compression_level is not None and (
+    parquet_compression.lower() == "none"
+    or not pa.Codec.supports_compression_level(parquet_compression)
+):
+    raise ValueError(
+        f"Codec '{parquet_compression}' doesn't support a compression level, "
+        "leave parquet_compression_level empty"
+    )
+
+# Low-cardinality columns to sort each row group by (comma-separated)
+sort_keys = [
+    (column.strip(), "ascending")
+    for column in os.getenv("sort_columns", "").split(",")
+    if column.strip()
+]
+
+# Size of each multipart upload part (S3 requires at least 5 MB except the last one)
+part_size = 8 << 20
+content_type = "application/vnd.apache.parquet"
+
+# CSV block size read per batch; peak memory stays around one block
+csv_block_size = 4 << 20
+
+# Row group and page sizes kept small so encoding buffers fit a 128 MB Lambda
+row_group_size = 50_000
+data_page_size = 256 << 10
+write_batch_size = 1024
+
+
+class S3MultipartWriter:
     """
-    Check if a file exists in the specified S3 bucket.
+    Write-only file-like object that streams bytes to S3 as a multipart upload.
+
+    Data is buffered until a full part is collected, so peak memory stays
+    bounded to a single part instead of the whole object. Objects smaller
+    than one part are sent with a single put_object call instead. Writes are
+    conditional and fail with PreconditionFailed if the key already exists.
 
     Args:
-        bucket_name (str): Name of the S3 bucket.
-        destination_path (str): Full path of the file within the bucket.
+        key (str): Destination key within the bucket.
+    """
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+        self.closed = False
+        self._position = 0
+        self._buffer = io.BytesIO()
+        self._parts: List[Dict[str, Any]] = []
+        self._upload_id: Optional[str] = None
+
+    def write(self, data: bytes) -> int:
+        """Buffer data and upload a part once enough bytes are collected."""
+        written = self._buffer.write(data)
+        self._position += written
+        if self._buffer.tell() >= part_size:
+            self._upload_part()
+        return written
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def _upload_part(self) -> None:
+        if self._upload_id is None:
+            response = s3.create_multipart_upload(
+                Bucket=bucket_name, Key=self.key, ContentType=content_type
+            )
+            self._upload_id = response["UploadId"]
+        part_number = len(self._parts) + 1
+        response = s3.upload_part(
+            Bucket=bucket_name,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=self._buffer.getvalue(),
+        )
+        self._parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        self._buffer = io.BytesIO()
+
+    def complete(self) -> None:
+        """Upload the remaining buffered bytes and finalize the object."""
+        if self._upload_id is None:
+            s3.put_object(
+                Bucket=bucket_name,
+                Key=self.key,
+                Body=self._buffer.getvalue(),
+                ContentType=content_type,
+                IfNoneMatch="*",
+            )
+            return
+        if self._buffer.tell():
+            self._upload_part()
+        s3.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=self.key,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._parts},
+            IfNoneMatch="*",
+        )
+
+    def abort(self) -> None:
+        """Discard all uploaded parts."""
+        if self._upload_id is not None:
+            s3.abort_multipart_upload(
+                Bucket=bucket_name, Key=self.key, UploadId=self._upload_id
+            )
+
+
+class S3SelectReader:
+    """
+    Read-only file-like object over the CSV records returned by S3 Select.
+
+    The CSV is parsed by S3 and only the projected columns are sent back,
+    without a header row.
+
+    Args:
+        key (str): Source key within the bucket.
+        columns (List[str]): Names of the columns to keep.
+    """
+
+    def __init__(self, key: str, columns: List[str]) -> None:
+        projection = ", ".join(
+            's."{}"'.format(column.replace('"', '""')) for column in columns
+        )
+        response = s3.select_object_content(
+            Bucket=bucket_name,
+            Key=key,
+            ExpressionType="SQL",
+            Expression=f"SELECT {projection} FROM s3object s",
+            InputSerialization={"CSV": {"FileHeaderInfo": "USE"}},
+            OutputSerialization={"CSV": {}},
+        )
+        self.closed = False
+        self._position = 0
+        self._buffer = bytearray()
+        self._records = (
+            event["Records"]["Payload"]
+            for event in response["Payload"]
+            if "Records" in event
+        )
+
+    def read(self, size: int = -1) -> bytes:
+        """Return up to size bytes of CSV records (all remaining if negative)."""
+        while size < 0 or len(self._buffer) < size:
+            records = next(self._records, None)
+            if records is None:
+                break
+            self._buffer += records
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._position += len(data)
+        return data
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def load_column_types(schema_path: str) -> Dict[str, pa.DataType]:
+    """
+    Load CSV column types from a JSON file mapping column names to Arrow type
+    names (e.g. {"id": "int32", "name": "string"}).
+
+    Args:
+        schema_path (str): Path to the JSON schema file.
 
     Returns:
-        bool: True if the file exists, False otherwise.
+        Dict[str, pa.DataType]: Column types, empty if the file does not exist.
     """
+    if not os.path.exists(schema_path):
+        return {}
+    with open(schema_path) as f:
+        schema = json.load(f)
+    return {column: pa.type_for_alias(alias) for column, alias in schema.items()}
+
+
+# Known CSV column types, loaded once per container; other columns are inferred
+column_types = load_column_types(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.json")
+)
+
+
+class CsvTypeMismatch(Exception):
+    """A CSV block does not match the column types inferred from the first block."""
+
+
+def read_batches(reader: pacsv.CSVStreamingReader) -> Iterator[pa.RecordBatch]:
+    """
+    Yield record batches from a streaming CSV reader.
+
+    Args:
+        reader (pacsv.CSVStreamingReader): Reader over the CSV file.
+
+    Returns:
+        Iterator[pa.RecordBatch]: Record batches of the CSV file.
+
+    Raises:
+        CsvTypeMismatch: If a block cannot be converted to the inferred types.
+    """
+    while True:
+        try:
+            batch = reader.read_next_batch()
+        except StopIteration:
+            return
+        except pa.ArrowInvalid as e:
+            # Only inferred columns can be fixed by re-reading the whole file
+            column = re.search(r"CSV column #(\d+): .*CSV conversion error", str(e))
+            if not column or reader.schema.names[int(column[1])] in column_types:
+                raise
+            raise CsvTypeMismatch(str(e)) from e
+        yield batch
+
+
+def open_source(source_path: str) -> Any:
+    """
+    Open the source CSV file as a readable stream, projecting columns
+    with S3 Select if configured.
+
+    Args:
+        source_path (str): Key of the CSV file within the bucket.
+
+    Returns:
+        Any: File-like object with the CSV content.
+    """
+    if select_columns:
+        return S3SelectReader(source_path, select_columns)
+    return s3.get_object(Bucket=bucket_name, Key=source_path)["Body"]
+
+
+def write_parquet(
+    destination_path: str, schema: pa.Schema, batches: Iterable[pa.RecordBatch]
+) -> int:
+    """
+    Write record batches to S3 as Parquet row groups.
+
+    Args:
+        destination_path (str): Key of the Parquet file within the bucket.
+        schema (pa.Schema): Schema of the record batches.
+        batches (Iterable[pa.RecordBatch]): Record batches to write.
+
+    Returns:
+        int: Number of rows written.
+    """
+    missing_columns = [column for column, _ in sort_keys if column not in schema.names]
+    if missing_columns:
+        raise ValueError(f"Sort columns not found in CSV: {missing_columns}")
+    sink = S3MultipartWriter(destination_path)
+    num_rows = 0
     try:
-        s3.head_object(Bucket=bucket_name, Key=destination_path)
-        return True
+        with pq.ParquetWriter(
+            sink,
+            schema,
+            compression=parquet_compression,
+            compression_level=parquet_compression_level,
+            use_dictionary=True,
+            write_statistics=True,
+            data_page_size=data_page_size,
+            write_batch_size=write_batch_size,
+        ) as writer:
+            for batch in batches:
+                table = pa.Table.from_batches([batch])
+                if sort_keys:
+                    table = table.sort_by(sort_keys)
+                writer.write_table(table, row_group_size=row_group_size)
+                num_rows += batch.num_rows
+        sink.complete()
     except Exception:
-        return False
+        sink.abort()
+        raise
+    return num_rows
 
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> None:
@@ -50,31 +343,52 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> None:
     if not (source_path.startswith(incoming_folder) and source_path.endswith(".csv")):
         return
 
-    destination_path = source_path.replace(incoming_folder, archive_folder).replace(
-        ".csv", ".parquet"
+    destination_path = (
+        archive_folder + source_path[incoming_folder_length:-4] + ".parquet"
+    )
+
+    read_options = pacsv.ReadOptions(
+        use_threads=True,
+        block_size=csv_block_size,
+        column_names=select_columns or None,
     )
+    convert_options = pacsv.ConvertOptions(column_types=column_types)
 
-    # Skip processing if file was already handled
-    if s3_file_exist(destination_path):
+    try:
+        try:
+            # Stream CSV blocks to Parquet; types are inferred from the first block
+            reader = pacsv.open_csv(
+                open_source(source_path),
+                read_options=read_options,
+                convert_options=convert_options,
+            )
+            num_rows = write_parquet(
+                destination_path, reader.schema, read_batches(reader)
+            )
+        except CsvTypeMismatch as e:
+            # A later block did not match the inferred types, so read the whole
+            # file to infer types over all rows (pin them with schema.json instead)
+            print(f"⚠️ {source_path}: {e}; retrying with whole-file type inference")
+            table = pacsv.read_csv(
+                open_source(source_path),
+                read_options=read_options,
+                convert_options=convert_options,
+            )
+            num_rows = write_parquet(
+                destination_path,
+                table.schema,
+                table.to_batches(max_chunksize=row_group_size),
+            )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "PreconditionFailed":
+            raise
+        # Skip the upload if file was already handled
         s3.delete_object(Bucket=bucket_name, Key=source_path)
         print(f"✅ {source_path}: already processed")
         return
 
-    # Read CSV file from S3
-    response = s3.get_object(Bucket=bucket_name, Key=source_path)
-    body = response["Body"]
-    df = pd.read_csv(body)
-
-    # Convert DataFrame to Parquet in-memory
-    buffer = io.BytesIO()
-    df.to_parquet(buffer, index=False, engine="pyarrow")
-    buffer.seek(0)
-
-    # Upload the Parquet file to S3
-    s3.upload_fileobj(buffer, Bucket=bucket_name, Key=destination_path)
-
     # Delete the original CSV file
     s3.delete_object(Bucket=bucket_name, Key=source_path)
 
     # Confirmation - can be observed in CloudWatch
-    print(f"✅ {source_path} -> {destination_path} ({len(df)} rows)")
+    print(f"✅ {source_path} -> {destination_path} ({num_rows} rows)")
@@ -1,19 +1,77 @@
+import io
 import json
 import os
-import subprocess
-import tempfile
+import sys
 import time
 import zipfile
+from functools import lru_cache
+from types import SimpleNamespace
 from typing import Any, Dict, Optional
 
 import boto3
-from hydra import compose, initialize
+import yaml
+from botocore.config import Config
 
 s3 = boto3.client("s3")
+iam = boto3.client("iam")
 
+# Polling settings for boto3 waiters used between deployment steps
+WAITER_CONFIG = {"Delay": 1, "MaxAttempts": 30}
 
-def create_s3_bucket_cli(bucket_name: str, region: str = "us-east-1") -> None:
-    """Create an S3 bucket using the AWS CLI.
+# Attempts to create the Lambda function while its new IAM role propagates
+# (exponential backoff: 1, 2, 4, 8 and 16 seconds between attempts)
+CREATE_FUNCTION_ATTEMPTS = 6
+
+# Trust policy allowing AWS Lambda to assume the execution role
+TRUST_POLICY_JSON = json.dumps(
+    {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Effect": "Allow",
+                "Principal": {"Service": "lambda.amazonaws.com"},
+                "Action": "sts:AssumeRole",
+            }
+        ],
+    }
+)
+
+# Zip archives larger than this are uploaded to S3 instead of sent inline
+LAMBDA_ZIP_S3_THRESHOLD = 4_000_000
+LAMBDA_ZIP_S3_KEY = "lambda/function.zip"
+
+
+def load_config(path: str) -> SimpleNamespace:
+    """Load YAML settings with attribute access to nested sections.
+
+    Args:
+        path (str): Path to the YAML settings file.
+
+    Returns:
+        SimpleNamespace: Configuration settings.
+    """
+    with open(path) as f:
+        settings = yaml.safe_load(f)
+    return json.loads(json.dumps(settings), object_hook=lambda d: SimpleNamespace(**d))
+
+
+@lru_cache(maxsize=None)
+def get_lambda_client(region: str) -> Any:
+    """Return a Lambda client for the region, created once and then reused.
+
+    Args:
+        region (str): AWS region.
+
+    Returns:
+        Any: boto3 Lambda client.
+    """
+    return boto3.client(
+        "lambda", region_name=region, config=Config(max_pool_connections=20)
+    )
+
+
+def create_s3_bucket(bucket_name: str, region: str = "us-east-1") -> None:
+    """Create an S3 bucket.
 
     Args:
         bucket_name (str): The name of the bucket to create.
@@ -21,26 +79,15 @@ def create_s3_bucket_cli(bucket_name: str, region: str = "us-east-1") -> None:
     """
     try:
         if region == "us-east-1":
-            cmd = ["aws", "s3api", "create-bucket", "--bucket", bucket_name]
+            s3.create_bucket(Bucket=bucket_name)
         else:
-            cmd = [
-                "aws",
-                "s3api",
-                "create-bucket",
-                "--bucket",
-                bucket_name,
-                "--region",
-                region,
-                "--create-bucket-configuration",
-                f"LocationConstraint={region}",
-            ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode == 0:
-            print(f"✅ Bucket '{bucket_name}' created successfully.")
-        else:
-            print(f"❌ Error creating bucket:\n{result.stderr}")
+            s3.create_bucket(
+                Bucket=bucket_name,
+                CreateBucketConfiguration={"LocationConstraint": region},
+            )
+        print(f"✅ Bucket '{bucket_name}' created successfully.")
     except Exception as e:
-        print(f"❌ Unexpected error: {e}")
+        print(f"❌ Error creating bucket:\n{e}")
 
 
 def create_s3_folder(bucket_name: str, folder_name: str) -> None:
@@ -88,80 +135,91 @@ def set_s3_lifecycle_expiration(
         print(f"❌ Failed to set lifecycle rule: {e}")
 
 
-def create_iam_role_for_lambda_cli(role_name: str) -> Optional[str]:
+def create_iam_role_for_lambda(role_name: str) -> Optional[str]:
     """Create an IAM role for AWS Lambda with S3 and CloudWatch access.
 
+    An existing role with the same name is reused, so the deployment can be
+    re-run.
+
     Args:
         role_name (str): Name of the IAM role.
 
     Returns:
-        Optional[str]: The ARN of the created IAM role, or None on failure.
+        Optional[str]: The ARN of the IAM role, or None on failure.
     """
-    role_arn = None
-    trust_policy = {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Effect": "Allow",
-                "Principal": {"Service": "lambda.amazonaws.com"},
-                "Action": "sts:AssumeRole",
-            }
-        ],
-    }
     try:
-        with tempfile.NamedTemporaryFile(
-            mode="w+", delete=False, suffix=".json"
-        ) as tmp_file:
-            json.dump(trust_policy, tmp_file)
-            tmp_file_path = tmp_file.name
-        create_cmd = [
-            "aws",
-            "iam",
-            "create-role",
-            "--role-name",
-            role_name,
-            "--assume-role-policy-document",
-            f"file://{tmp_file_path}",
-            "--description",
-            "IAM role for AWS Lambda with S3 and CloudWatch access",
-        ]
-        result = subprocess.run(create_cmd, capture_output=True, text=True)
-        response = json.loads(result.stdout)
-        role_arn = response["Role"]["Arn"]
-        for policy_arn in [
-            "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole",
-            "arn:aws:iam::aws:policy/AmazonS3FullAccess",
-        ]:
-            subprocess.run(
-                [
-                    "aws",
-                    "iam",
-                    "attach-role-policy",
-                    "--role-name",
-                    role_name,
-                    "--policy-arn",
-                    policy_arn,
-                ],
-                capture_output=True,
-                text=True,
-            )
-        print(f"✅ IAM role '{role_name}' created and policies attached.")
-    finally:
-        if os.path.exists(tmp_file_path):
-            os.remove(tmp_file_path)
-    return role_arn
-
-
-def zip_lambda_function(source_file: str, zip_file: str) -> None:
-    """Zip the Lambda function source file.
+        response = iam.create_role(
+            RoleName=role_name,
+            AssumeRolePolicyDocument=TRUST_POLICY_JSON,
+            Description="IAM role for AWS Lambda with S3 and CloudWatch access",
+        )
+        print(f"✅ IAM role '{role_name}' created.")
+    except iam.exceptions.EntityAlreadyExistsException:
+        response = iam.get_role(RoleName=role_name)
+        print(f"⚠️ IAM role '{role_name}' already exists.")
+    except Exception as e:
+        print(f"❌ Error creating IAM role: {e}")
+        return None
+    # Attaching an already attached policy is a no-op
+    for policy_arn in [
+        "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole",
+        "arn:aws:iam::aws:policy/AmazonS3FullAccess",
+    ]:
+        try:
+            iam.attach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
+            print(f"✅ Policy '{policy_arn}' attached to '{role_name}'.")
+        except Exception as e:
+            print(f"❌ Failed to attach policy '{policy_arn}': {e}")
+    return response["Role"]["Arn"]
+
+
+def zip_lambda_function(source_file: str, schema_file: Optional[str] = None) -> bytes:
+    """Zip the Lambda function source file in memory.
 
     Args:
         source_file (str): Path to the Python file to zip.
-        zip_file (str): Output zip file path.
+        schema_file (Optional[str]): Path to the CSV schema JSON, bundled as
+            'schema.json' if it exists.
+
+    Returns:
+        bytes: Content of the zip archive.
     """
-    with zipfile.ZipFile(zip_file, "w") as z:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(
+        buffer, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6
+    ) as z:
         z.write(source_file, arcname=os.path.basename(source_file))
-    print(f"✅ '{source_file}' -> '{zip_file}'")
+        if schema_file and os.path.exists(schema_file):
+            z.write(schema_file, arcname="schema.json")
+    zipped_code = buffer.getvalue()
+    print(f"✅ '{source_file}' zipped ({len(zipped_code)} bytes)")
+    return zipped_code
+
+
+def create_function_with_retry(lambda_client: Any, **kwargs: Any) -> Dict[str, Any]:
+    """Create a Lambda function, retrying while its IAM role propagates.
+
+    A new IAM role can be read right after creation, but Lambda can only
+    assume it a few seconds later; until then create_function fails with
+    InvalidParameterValueException saying the role cannot be assumed.
+
+    Args:
+        lambda_client (Any): boto3 Lambda client.
+        **kwargs (Any): Arguments passed to create_function.
+
+    Returns:
+        Dict[str, Any]: The create_function response.
+    """
+    for attempt in range(CREATE_FUNCTION_ATTEMPTS - 1):
+        try:
+            return lambda_client.create_function(**kwargs)
+        except lambda_client.exceptions.InvalidParameterValueException as e:
+            # Other invalid parameters (runtime, handler, code) are permanent
+            if "cannot be assumed by Lambda" not in str(e):
+                raise
+            print(f"⏳ Waiting for IAM role to propagate: {e}")
+            time.sleep(2**attempt)
+    return lambda_client.create_function(**kwargs)
 
 
 def create_lambda_function_from_py(
@@ -171,6 +229,8 @@ def create_lambda_function_from_py(
     handler_name: str = "lambda_function.lambda_handler",
     runtime: str = "python3.13",
     region: str = "us-east-1",
+    schema_file: Optional[str] = None,
+    code_bucket: Optional[str] = None,
 ) -> Optional[str]:
     """Create a Lambda function from a Python file.
 
@@ -181,56 +241,73 @@ def create_lambda_function_from_py(
         handler_name (str): Function handler name.
         runtime (str): Python runtime version.
         region (str): AWS region.
+        schema_file (Optional[str]): Path to the CSV schema JSON to bundle.
+        code_bucket (Optional[str]): S3 bucket used to stage large zip archives.
 
     Returns:
         Optional[str]: ARN of the created Lambda function.
     """
-    zip_file = "function.zip"
-    zip_lambda_function(source_file, zip_file)
-    lambda_client = boto3.client("lambda", region_name=region)
-    with open(zip_file, "rb") as f:
-        zipped_code = f.read()
+    zipped_code = zip_lambda_function(source_file, schema_file)
+    lambda_client = get_lambda_client(region)
+    staged = False
     try:
-        response = lambda_client.create_function(
+        if code_bucket and len(zipped_code) > LAMBDA_ZIP_S3_THRESHOLD:
+            # Avoid base64-encoding a large archive into the CreateFunction request
+            s3.put_object(Bucket=code_bucket, Key=LAMBDA_ZIP_S3_KEY, Body=zipped_code)
+            staged = True
+            code = {"S3Bucket": code_bucket, "S3Key": LAMBDA_ZIP_S3_KEY}
+        else:
+            code = {"ZipFile": zipped_code}
+        response = create_function_with_retry(
+            lambda_client,
             FunctionName=function_name,
             Runtime=runtime,
             Role=role_arn,
             Handler=handler_name,
-            Code={"ZipFile": zipped_code},
+            Code=code,
             Description="Lambda created from Python file",
             Timeout=10,
             MemorySize=128,
             Publish=True,
         )
         print(f"✅ Lambda function '{function_name}' created successfully.")
-        os.remove(zip_file)
         return response["FunctionArn"]
     except lambda_client.exceptions.ResourceConflictException:
         print(f"⚠️ Lambda function '{function_name}' already exists.")
     except Exception as e:
         print(f"❌ Error creating Lambda function: {e}")
-    if os.path.exists(zip_file):
-        os.remove(zip_file)
+    finally:
+        # Lambda keeps its own copy of the code, so drop the staged archive
+        if staged:
+            s3.delete_object(Bucket=code_bucket, Key=LAMBDA_ZIP_S3_KEY)
     return None
 
 
-def update_lambda_env_variables(cfg: Dict[str, Any]) -> None:
+def update_lambda_env_variables(cfg: SimpleNamespace) -> None:
     """
     Update AWS Lambda environment variables for the specified function.
 
     Args:
-        cfg (Dict[str, Any]): configuration settings.
+        cfg (SimpleNamespace): configuration settings.
 
     Returns:
         None
     """
-    lambda_client = boto3.client("lambda", region_name=cfg.aws.region)
+    lambda_client = get_lambda_client(cfg.aws.region)
 
     # Define the new environment variables
     new_env_vars = {
         "bucket_name": cfg.s3.bucket_name,
         "incoming_folder": cfg.s3.incoming_folder,
         "archive_folder": cfg.s3.archive_folder,
+        "select_columns": ",".join(cfg.s3.select_columns),
+        "parquet_compression": cfg.parquet.compression,
+        "parquet_compression_level": (
+            ""
+            if cfg.parquet.compression_level is None
+            else str(cfg.parquet.compression_level)
+        ),
+        "sort_columns": ",".join(cfg.parquet.sort_columns),
     }
 
     # Fetch existing environment variables and merge
@@ -260,7 +337,7 @@ def add_pandas_layer_to_lambda(
         layer_arn (str): ARN of the Pandas layer.
         region (str): AWS region.
     """
-    lambda_client = boto3.client("lambda", region_name=region)
+    lambda_client = get_lambda_client(region)
     response = lambda_client.get_function_configuration(FunctionName=function_name)
     existing_layer_arns = [layer["Arn"] for layer in response.get("Layers", [])]
     updated_layers = existing_layer_arns + [layer_arn]
@@ -287,7 +364,7 @@ def add_s3_trigger_to_lambda(
         prefix (str): Key prefix filter for object-created events.
         region (str): AWS region.
     """
-    lambda_client = boto3.client("lambda", region_name=region)
+    lambda_client = get_lambda_client(region)
     function_name = lambda_function_arn.split(":")[-1]
     try:
         lambda_client.add_permission(
@@ -323,48 +400,60 @@ def add_s3_trigger_to_lambda(
 
 
 if __name__ == "__main__":
-    # Initialize Hydra configuration
-    with initialize(version_base=None, config_path=".", job_name="app"):
-        cfg = compose(config_name="settings")
+    # Load configuration
+    cfg = load_config("settings.yaml")
 
-        # Step 1: Create S3 resources (bucket and folders)
-        create_s3_bucket_cli(cfg.s3.bucket_name, region=cfg.aws.region)
-        create_s3_folder(cfg.s3.bucket_name, cfg.s3.incoming_folder)
-        create_s3_folder(cfg.s3.bucket_name, cfg.s3.archive_folder)
+    # Step 1: Create S3 resources (bucket and folders)
+    create_s3_bucket(cfg.s3.bucket_name, region=cfg.aws.region)
+    create_s3_folder(cfg.s3.bucket_name, cfg.s3.incoming_folder)
+    create_s3_folder(cfg.s3.bucket_name, cfg.s3.archive_folder)
 
-        # Step 2: Configure lifecycle rule to expire archived files
-        set_s3_lifecycle_expiration(cfg.s3.bucket_name, prefix=cfg.s3.archive_folder)
+    # Step 2: Configure lifecycle rule to expire archived files
+    set_s3_lifecycle_expiration(cfg.s3.bucket_name, prefix=cfg.s3.archive_folder)
 
-        # Step 3: Create IAM role for Lambda
-        role_arn = create_iam_role_for_lambda_cli(cfg.aws.role_name)
+    # Step 3: Create IAM role for Lambda
+    role_arn = create_iam_role_for_lambda(cfg.aws.role_name)
 
-        # Wait a few seconds to ensure the IAM role is fully propagated
-        time.sleep(5)
+    # Wait until the IAM role can be read (Lambda may need a few more seconds to
+    # assume it, which create_function_with_retry handles)
+    iam.get_waiter("role_exists").wait(
+        RoleName=cfg.aws.role_name, WaiterConfig=WAITER_CONFIG
+    )
 
-        # Step 4: Deploy Lambda function from source file
-        function_arn = create_lambda_function_from_py(
-            function_name=cfg.func.name,
-            source_file=cfg.func.file_path,
-            role_arn=role_arn,
-        )
+    # Step 4: Deploy Lambda function from source file
+    function_arn = create_lambda_function_from_py(
+        function_name=cfg.func.name,
+        source_file=cfg.func.file_path,
+        role_arn=role_arn,
+        schema_file=cfg.func.schema_file_path,
+        code_bucket=cfg.s3.bucket_name,
+    )
 
-        # Wait a few seconds to ensure the Lambda function is ready
-        time.sleep(5)
+    # Stop here if the Lambda function was not created
+    if function_arn is None:
+        print("❌ Lambda function was not created, skipping remaining steps.")
+        sys.exit(1)
 
-        # Step 4.1: Set environment variables
-        update_lambda_env_variables(cfg)
+    # Wait until the Lambda function is active
+    lambda_client = get_lambda_client(cfg.aws.region)
+    lambda_client.get_waiter("function_active_v2").wait(
+        FunctionName=cfg.func.name, WaiterConfig=WAITER_CONFIG
+    )
 
-        # Wait a few seconds more
-        time.sleep(5)
+    # Step 4.1: Set environment variables
+    update_lambda_env_variables(cfg)
 
-        # Step 5: Add Pandas layer to Lambda function
-        add_pandas_layer_to_lambda(
-            cfg.func.name, cfg.func.pandas_layer_arn, cfg.aws.region
-        )
+    # Wait until the configuration update is applied
+    lambda_client.get_waiter("function_updated_v2").wait(
+        FunctionName=cfg.func.name, WaiterConfig=WAITER_CONFIG
+    )
 
-        # Step 6: Set up S3 trigger to invoke Lambda on file upload
-        add_s3_trigger_to_lambda(
-            bucket_name=cfg.s3.bucket_name,
-            lambda_function_arn=function_arn,
-            prefix=cfg.s3.incoming_folder + "/",
-        )
+    # Step 5: Add Pandas layer to Lambda function
+    add_pandas_layer_to_lambda(cfg.func.name, cfg.func.pandas_layer_arn, cfg.aws.region)
+
+    # Step 6: Set up S3 trigger to invoke Lambda on file upload
+    add_s3_trigger_to_lambda(
+        bucket_name=cfg.s3.bucket_name,
+        lambda_function_arn=function_arn,
+        prefix=cfg.s3.incoming_folder + "/",
+    )